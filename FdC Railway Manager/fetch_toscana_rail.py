@@ -1,209 +1,311 @@
+import argparse
+import contextlib
+import dataclasses
 import json
 import urllib.request
 import urllib.parse
 import math
+import re
 import sys
 import uuid
-import time
+from itertools import groupby
+
+try:
+    import numpy as np
+except ImportError:  # Senza NumPy si ripiega sul calcolo scalare
+    np = None
+
+try:
+    import orjson
+except ImportError:  # Senza orjson si usa il modulo json standard
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # Senza ijson la risposta viene caricata per intero
+    ijson = None
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+except ImportError:  # Senza requests si usa urllib, con una connessione per richiesta
+    requests = None
 
 # Configurazione
 # Configurazione
 FILENAME = "Toscana.rail"
 OVERPASS_URL = "https://lz4.overpass-api.de/api/interpreter"
 
-# Queries separate per evitare timeout
-QUERIES = [
-    # 1. Toscana (Espande a La Spezia/Roma tramite relazioni)
-    """
+# Aree Overpass (3600000000 + id relazione OSM), unite in un'unica query
+AREE = [
+    3600041977, # Toscana (Espande a La Spezia/Roma tramite relazioni)
+]
+
+QUERY = f"""
     [out:json][timeout:300];
-    area(3600041977)->.searchArea;
+    ({"".join(f"area({a});" for a in AREE)})->.searchArea;
     relation["route"="train"](area.searchArea)->.rels;
     .rels out;
     node(r.rels)->.nodesOfRels;
     node.nodesOfRels["railway"~"station|halt|stop"]->.stations;
     .stations out;
     """
-]
 
-def scarica_dati_overpass(query_str):
-    print("  -> Invio richiesta Overpass...")
+STATION_TYPES = {'station', 'halt', 'stop'}
+
+_NO_TAGS = {} # Condiviso e mai modificato: evita un dict vuoto per ogni elemento senza tag
+
+# Prefisso "Stazione (di)" rimosso dai nomi in un solo passaggio
+_NAME_RE = re.compile(r"Stazione (?:di )?")
+
+# Nomi che identificano i nodi importanti (interscambi)
+INTERCHANGE_NAMES = ("Centrale", "S.M.N.", "P.P.", "Porta", "Bologna", "Genova", "Pisa", "Firenze")
+_INTERCHANGE_RE = re.compile("|".join(map(re.escape, INTERCHANGE_NAMES)))
+
+# Classe della linea dal nome, in ordine di priorità: (sottostringa, (colore, tipo binario, velocità max))
+_CLASSI_LINEA = (
+    ("Frec", ("#FF0000", "highSpeed", 250)),
+    ("IC", ("#FFA500", "double", 180)),
+    ("Direttissima", ("#0000FF", "double", 180)),
+    ("Tirrenica", ("#0000FF", "double", 140)),
+)
+_CLASSE_LINEA_DEFAULT = ("#0000FF", "single", 140)
+
+def crea_sessione():
+    # Connessione keep-alive riusata tra le query, con retry e backoff su 429/504
+    # al posto della pausa fissa tra le richieste
+    opzioni = dict(total=3, backoff_factor=1, status_forcelist=(429, 504))
     try:
+        retry = Retry(allowed_methods=None, **opzioni)
+    except TypeError:  # urllib3 < 1.26: stessa opzione con il vecchio nome
+        retry = Retry(method_whitelist=False, **opzioni)
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retry))
+    return session
+
+_session = crea_sessione() if requests is not None else None
+
+@contextlib.contextmanager
+def apri_risposta_overpass(query_str):
+    if _session is None:
         data = urllib.parse.urlencode({'data': query_str}).encode('utf-8')
         req = urllib.request.Request(OVERPASS_URL, data=data)
         with urllib.request.urlopen(req, timeout=300) as response:
-            return json.load(response)
-    except Exception as e:
-        print(f"  -> Errore Overpass: {e}")
-        return None
+            yield response
+        return
+    with _session.post(OVERPASS_URL, data={'data': query_str}, timeout=300, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        yield resp.raw
 
-def haversine_km(lat1, lon1, lat2, lon2):
+def scarica_elementi_overpass(query_str):
+    # Restituisce gli elementi man mano che arrivano: con ijson la risposta non viene mai
+    # caricata tutta in memoria
+    print("  -> Invio richiesta Overpass...")
+    with apri_risposta_overpass(query_str) as response:
+        if ijson is not None:
+            yield from ijson.items(response, 'elements.item', use_float=True)
+            return
+        res = orjson.loads(response.read()) if orjson is not None else json.load(response)
+        yield from res.get('elements', [])
+
+def haversine_km(rlat1, rlon1, clat1, rlat2, rlon2, clat2):
+    # Coordinate già in radianti, con il coseno della latitudine precalcolato
     R = 6371
-    dLat = math.radians(lat2 - lat1)
-    dLon = math.radians(lon2 - lon1)
-    a = math.sin(dLat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dLon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    dLat = rlat2 - rlat1
+    dLon = rlon2 - rlon1
+    a = math.sin(dLat/2)**2 + clat1 * clat2 * math.sin(dLon/2)**2
+    c = 2 * math.asin(math.sqrt(min(1.0, a)))
     return R * c
 
-def main():
+def distanze_km(nodes_db, coppie):
+    # Distanze haversine per tutte le coppie (u, v) in un unico calcolo vettoriale
+    if np is None:
+        # Radianti e coseni calcolati una volta per nodo, non per ogni segmento
+        rad = {}
+        for nid in {x for c in coppie for x in c}:
+            n = nodes_db[nid]
+            rlat = math.radians(n['lat'])
+            rad[nid] = (rlat, math.radians(n['lon']), math.cos(rlat))
+        return [haversine_km(*rad[u], *rad[v]) for u, v in coppie]
+    n = len(coppie)
+    lat1 = np.fromiter((nodes_db[u]['lat'] for u, _ in coppie), dtype=np.float64, count=n)
+    lon1 = np.fromiter((nodes_db[u]['lon'] for u, _ in coppie), dtype=np.float64, count=n)
+    lat2 = np.fromiter((nodes_db[v]['lat'] for _, v in coppie), dtype=np.float64, count=n)
+    lon2 = np.fromiter((nodes_db[v]['lon'] for _, v in coppie), dtype=np.float64, count=n)
+    R = 6371
+    dLat = np.radians(lat2 - lat1)
+    dLon = np.radians(lon2 - lon1)
+    a = np.sin(dLat/2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dLon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return (R * c).tolist()
+
+@dataclasses.dataclass(slots=True)
+class FdcNode:
+    # Stazione FDC (FDCNodeData): i campi seguono l'ordine delle chiavi nel .rail
+    id: str
+    name: str
+    type: str
+    latitude: float
+    longitude: float
+    platform_count: int
+    capacity: int
+
+def dumps_json(obj, indent=False):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    # orjson serializza i dataclass nativamente, json li converte con asdict.
+    # Entrambi scrivono UTF-8 senza escape \uXXXX, così il file non dipende da orjson
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False, default=dataclasses.asdict).encode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=dataclasses.asdict).encode()
+
+def scrivi_rail(path, name, sezioni, indent=False):
+    # Scrive il .rail una sezione e un elemento alla volta: ogni elemento viene serializzato
+    # appena prodotto, senza costruire né il documento completo né la sua versione testuale
+    nl = b"\n" if indent else b""
+    pad = b"  " if indent else b""
+    sp = b" " if indent else b""
+    rientro = b"\n    " if indent else b""
+    with open(path, 'wb') as f:
+        f.write(b"{" + nl + pad + b'"name":' + sp + dumps_json(name))
+        for chiave, elementi in sezioni:
+            f.write(b"," + nl + pad + dumps_json(chiave) + b":" + sp + b"[")
+            vuota = True
+            for el in elementi:
+                f.write((b"" if vuota else b",") + rientro + dumps_json(el, indent).replace(b"\n", rientro))
+                vuota = False
+            f.write((b"" if vuota else nl + pad) + b"]")
+        f.write(nl + b"}")
+
+def classifica_linea(route_name):
+    # Colore della linea, tipo di binario e velocità massima dei suoi segmenti
+    for chiave, classe in _CLASSI_LINEA:
+        if chiave in route_name:
+            return classe
+    return _CLASSE_LINEA_DEFAULT
+
+def make_node(el):
+    tags = el.get('tags') or _NO_TAGS
+    nid = el['id']
+    name = tags.get('name') or tags.get('ref') or f"Stop {nid}"
+    name = _NAME_RE.sub("", name)
+
+    ntype = "station"
+    # Logica semplice per identificare nodi importanti
+    if _INTERCHANGE_RE.search(name):
+        ntype = "interchange"
+
+    return FdcNode(
+        id=str(nid),
+        name=name,
+        type=ntype,
+        latitude=el['lat'],
+        longitude=el['lon'],
+        platform_count=10 if ntype == "interchange" else 2,
+        capacity=20 if ntype == "interchange" else 5
+    )
+
+def main(pretty=False):
     print("Elaborazione dati per formato FDC (Multi-Region)...")
     
-    all_elements = []
-    seen_ids = set()
-    
-    for i, q in enumerate(QUERIES):
-        print(f"Scaricando blocco {i+1}/{len(QUERIES)}...")
-        res = scarica_dati_overpass(q)
-        if res and 'elements' in res:
-            count = 0
-            for el in res['elements']:
-                if el['id'] not in seen_ids:
-                    all_elements.append(el)
-                    seen_ids.add(el['id'])
-                    count += 1
-            print(f"  -> Aggiunti {count} elementi.")
-        else:
-            print("  -> Nessun dato o errore.")
-            if i == 0: # Se fallisce il blocco principale
-                print("Impossibile procedere senza il blocco principale.")
-                sys.exit(1)
-        time.sleep(2)
-
     nodes_db = {}
-    relations = []
+    relations = {}
+    fdc_nodes = {} # 1. Stazioni (FDCNodeData), riconosciute già in fase di lettura
     
-    for el in all_elements:
+    print(f"Scaricando {len(AREE)} aree in un'unica richiesta...")
+    count = 0
+    elementi = scarica_elementi_overpass(QUERY)
+    while True:
+        # Solo download e parsing sono protetti: errori nell'elaborazione restano visibili
+        try:
+            el = next(elementi, None)
+        except Exception as e:
+            print(f"  -> Errore Overpass: {e}")
+            print("Impossibile procedere senza dati.")
+            sys.exit(1)
+        if el is None: break
         if el['type'] == 'node':
-            nodes_db[el['id']] = el
+            nid = el['id'] # Id OSM nativi (int), convertiti in stringa solo in output
+            if nid not in nodes_db:
+                nodes_db[nid] = el
+                count += 1
+                if (el.get('tags') or _NO_TAGS).get('railway') in STATION_TYPES:
+                    fdc_nodes[nid] = make_node(el)
         elif el['type'] == 'relation':
-            relations.append(el)
+            if el['id'] not in relations:
+                relations[el['id']] = el
+                count += 1
+    if count == 0: # Risposta senza 'elements': non sovrascrivere il .rail con una rete vuota
+        print("  -> Nessun dato o errore.")
+        print("Impossibile procedere senza dati.")
+        sys.exit(1)
+    print(f"  -> Aggiunti {count} elementi.")
 
     print(f"Totale Dataset: {len(nodes_db)} nodi, {len(relations)} relazioni.")
 
-    # 1. Stazioni (FDCNodeData)
-    fdc_nodes = {} 
-    
-    def make_node(el):
-        tags = el.get('tags', {})
-        nid = str(el['id'])
-        name = tags.get('name', tags.get('ref', f"Stop {nid}"))
-        name = name.replace("Stazione di ", "").replace("Stazione ", "")
-        
-        ntype = "station"
-        # Logica semplice per identificare nodi importanti
-        if any(x in name for x in ["Centrale", "S.M.N.", "P.P.", "Porta", "Bologna", "Genova", "Pisa", "Firenze"]): 
-            ntype = "interchange"
-        
-        return {
-            "id": nid,
-            "name": name,
-            "type": ntype,
-            "latitude": el['lat'],
-            "longitude": el['lon'],
-            "platform_count": 10 if ntype == "interchange" else 2,
-            "capacity": 20 if ntype == "interchange" else 5
-        }
-
-    for nid, el in nodes_db.items():
-        tags = el.get('tags', {})
-        if 'railway' in tags and tags['railway'] in ['station', 'halt', 'stop']:
-            fdc_nodes[str(nid)] = make_node(el)
-
     # 2. Linee (FDCLineData) e Edges (FDCEdgeData)
     
-    output_edges = [] 
-    output_lines = [] 
+    edge_candidates = [] # (u, v, trackType, maxSpeed): distanze calcolate in blocco alla fine
+    output_lines = [] # (id relazione, nome, colore, fermate): dict creati solo in scrittura
     existing_edges = set()
     
-    for rel in relations:
-        tags = rel.get('tags', {})
-        route_name = tags.get('name', tags.get('ref', 'Linea'))
-        
-        members = rel.get('members', [])
-        current_stops = []
-        
-        for m in members:
-            if m['type'] == 'node':
-                mid = str(m['ref'])
-                if mid in fdc_nodes:
-                    current_stops.append(mid)
-                elif mid in nodes_db:
-                    el = nodes_db[int(mid)]
-                    # Se è un nodo che fa parte della relazione ma non taggato come stazione esplicitamente,
-                    # lo promuoviamo se ha un nome o ruolo 'stop'
-                    if 'name' in el.get('tags', {}) or m.get('role') in ['stop', 'platform', 'station']:
-                         new = make_node(el)
-                         fdc_nodes[mid] = new
-                         current_stops.append(mid)
-        
-        if not current_stops: continue
+    for rel in relations.values():
+        tags = rel.get('tags') or _NO_TAGS
+        route_name = tags.get('name') or tags.get('ref') or 'Linea'
         
         # Filtra duplicati consecutivi
-        unique = [current_stops[0]]
-        for s in current_stops[1:]:
-            if s != unique[-1]: unique.append(s)
+        unique = [s for s, _ in groupby(m['ref'] for m in rel.get('members', [])
+                                        if m['type'] == 'node' and m['ref'] in fdc_nodes)]
         
         if len(unique) < 2: continue
         
         # Create FDC Line
-        color = "#0000FF"
-        if "Frec" in route_name: color = "#FF0000"
-        elif "IC" in route_name: color = "#FFA500"
+        color, ttype, max_s = classifica_linea(route_name)
         
-        output_lines.append({
-            "id": f"L_{rel['id']}",
-            "name": route_name,
-            "color": color,
-            "stops": [{"stationId": s, "minDwellTime": 3} for s in unique]
-        })
+        output_lines.append((rel['id'], route_name, color, unique))
         
         # Create Edges
         for i in range(len(unique) - 1):
             u, v = unique[i], unique[i+1]
-            k = tuple(sorted((u, v)))
+            k = (u, v) if u < v else (v, u) # Chiave canonica, senza sorted()
             if k in existing_edges: continue
             existing_edges.add(k)
             
-            if int(u) not in nodes_db or int(v) not in nodes_db: continue
-            
-            n1 = nodes_db[int(u)]
-            n2 = nodes_db[int(v)]
-            dist = haversine_km(n1['lat'], n1['lon'], n2['lat'], n2['lon']) * 1.25 # Fattore correzione binario curvo
+            if u not in nodes_db or v not in nodes_db: continue
             
-            ttype = "single"
-            max_s = 140.0
-            
-            if "Frec" in route_name:
-                ttype = "highSpeed"
-                max_s = 250.0
-            elif "IC" in route_name or "Direttissima" in route_name:
-                ttype = "double"
-                max_s = 180.0
-            elif "Tirrenica" in route_name:
-                ttype = "double"
-            
-            output_edges.append({
-                "from": u,
-                "to": v,
-                "distance": max(0.5, round(dist, 2)),
-                "trackType": ttype,
-                "maxSpeed": int(max_s),
-                "capacity": 10
-            })
-
-    print(f"Risultato: {len(output_lines)} linee, {len(output_edges)} segmenti, {len(fdc_nodes)} stazioni.")
+            edge_candidates.append((u, v, ttype, max_s))
+
+    distanze = distanze_km(nodes_db, [(u, v) for u, v, _, _ in edge_candidates])
+    output_edges = ({
+        "from": str(u),
+        "to": str(v),
+        "distance": max(0.5, round(dist * 1.25, 2)), # Fattore correzione binario curvo
+        "trackType": ttype,
+        "maxSpeed": max_s,
+        "capacity": 10
+    } for (u, v, ttype, max_s), dist in zip(edge_candidates, distanze))
+    righe_linee = ({
+        "id": f"L_{rid}",
+        "name": route_name,
+        "color": color,
+        "stops": [{"stationId": str(s), "minDwellTime": 3} for s in stops]
+    } for rid, route_name, color, stops in output_lines)
+
+    print(f"Risultato: {len(output_lines)} linee, {len(edge_candidates)} segmenti, {len(fdc_nodes)} stazioni.")
     
     # Root Structure (RailwayNetworkDTO for .rail)
-    final_output = {
-        "name": "Toscana",
-        "nodes": list(fdc_nodes.values()),
-        "edges": output_edges,
-        "lines": output_lines,
-        "trains": []
-    }
-    
-    with open(FILENAME, 'w') as f:
-        json.dump(final_output, f, indent=2)
+    scrivi_rail(FILENAME, "Toscana", [
+        ("nodes", fdc_nodes.values()),
+        ("edges", output_edges),
+        ("lines", righe_linee),
+        ("trains", []),
+    ], indent=pretty)
     print(f"Salvato in {FILENAME} (Formato FDC Compatibile)")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Scarica la rete ferroviaria da Overpass e la salva in formato .rail (FDC)")
+    parser.add_argument("--pretty", action="store_true", help="scrive il .rail indentato invece che compatto")
+    args = parser.parse_args()
+    main(pretty=args.pretty)
@@ -0,0 +1,136 @@
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "FdC Railway Manager", "fetch_toscana_rail.py")
+
+spec = importlib.util.spec_from_file_location("fetch_toscana_rail", SCRIPT)
+f = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(f)
+
+PAYLOAD = {
+    "elements": [
+        {"type": "node", "id": 1, "lat": 43.7760, "lon": 11.2479, "tags": {"railway": "station", "name": "Firenze S.M.N."}},
+        {"type": "node", "id": 2, "lat": 43.7085, "lon": 10.3986, "tags": {"railway": "station", "name": "Stazione di Pisa Centrale"}},
+        {"type": "node", "id": 3, "lat": 44.2225, "lon": 12.0408, "tags": {"railway": "halt", "name": "Forlì"}},
+        {"type": "relation", "id": 10, "tags": {"name": "IC Firenze - Pisa"},
+         "members": [{"type": "node", "ref": 1, "role": "stop"}, {"type": "node", "ref": 2, "role": "stop"},
+                     {"type": "node", "ref": 3, "role": "stop"}]},
+    ]
+}
+
+
+class _Risposta(io.BytesIO):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _urlopen(payload):
+    return mock.patch("urllib.request.urlopen", side_effect=lambda *a, **k: _Risposta(json.dumps(payload).encode()))
+
+
+class ScaricaElementiTest(unittest.TestCase):
+    def scarica(self):
+        with mock.patch("builtins.print"):
+            return list(f.scarica_elementi_overpass(f.QUERY))
+
+    def test_urllib_json(self):
+        with mock.patch.object(f, "_session", None), mock.patch.object(f, "ijson", None), \
+                mock.patch.object(f, "orjson", None), _urlopen(PAYLOAD):
+            self.assertEqual(self.scarica(), PAYLOAD["elements"])
+
+    @unittest.skipIf(f.ijson is None, "ijson non installato")
+    def test_ijson_stream(self):
+        with mock.patch.object(f, "_session", None), _urlopen(PAYLOAD):
+            self.assertEqual(self.scarica(), PAYLOAD["elements"])
+
+    @unittest.skipIf(f.requests is None, "requests non installato")
+    def test_requests_session(self):
+        resp = mock.MagicMock()
+        resp.__enter__.return_value = resp
+        resp.raw = _Risposta(json.dumps(PAYLOAD).encode())
+        session = f.crea_sessione()
+        with mock.patch.object(f, "_session", session), mock.patch.object(session, "post", return_value=resp) as post:
+            self.assertEqual(self.scarica(), PAYLOAD["elements"])
+        post.assert_called_once_with(f.OVERPASS_URL, data={"data": f.QUERY}, timeout=300, stream=True)
+        resp.raise_for_status.assert_called_once_with()
+        self.assertTrue(resp.raw.decode_content)
+
+    @unittest.skipIf(f.requests is None, "requests non installato")
+    def test_sessione_retry(self):
+        retry = f.crea_sessione().get_adapter(f.OVERPASS_URL).max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertEqual(set(retry.status_forcelist), {429, 504})
+        self.assertTrue(retry.is_retry("POST", 429))
+
+    @unittest.skipIf(f.requests is None, "requests non installato")
+    def test_sessione_urllib3_senza_allowed_methods(self):
+        reale = f.Retry(total=3, backoff_factor=1, status_forcelist=(429, 504))
+        with mock.patch.object(f, "Retry", side_effect=[TypeError("allowed_methods"), reale]) as retry:
+            self.assertIs(f.crea_sessione().get_adapter(f.OVERPASS_URL).max_retries, reale)
+        self.assertIs(retry.call_args.kwargs["method_whitelist"], False)
+
+
+class DistanzeTest(unittest.TestCase):
+    NODI = {n["id"]: n for n in PAYLOAD["elements"] if n["type"] == "node"}
+    COPPIE = [(1, 2), (2, 3), (1, 1)]
+
+    def test_scalare(self):
+        with mock.patch.object(f, "np", None):
+            d = f.distanze_km(self.NODI, self.COPPIE)
+        self.assertAlmostEqual(d[0], 68.7, delta=0.5)
+        self.assertEqual(d[2], 0.0)
+
+    @unittest.skipIf(f.np is None, "NumPy non installato")
+    def test_numpy_come_scalare(self):
+        with mock.patch.object(f, "np", None):
+            attese = f.distanze_km(self.NODI, self.COPPIE)
+        for d, attesa in zip(f.distanze_km(self.NODI, self.COPPIE), attese):
+            self.assertAlmostEqual(d, attesa, places=9)
+
+
+class DumpsJsonTest(unittest.TestCase):
+    OGGETTO = [f.make_node(PAYLOAD["elements"][2]), {"a": [1, 2.5, "è"]}]
+
+    @unittest.skipIf(f.orjson is None, "orjson non installato")
+    def test_orjson_come_json(self):
+        for indent in (False, True):
+            with mock.patch.object(f, "orjson", None):
+                atteso = f.dumps_json(self.OGGETTO, indent)
+            self.assertEqual(f.dumps_json(self.OGGETTO, indent), atteso)
+
+
+class MainTest(unittest.TestCase):
+    def esegui(self, payload, pretty=False):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(f, "_session", None), \
+                mock.patch.object(f, "FILENAME", os.path.join(tmp, "out.rail")), _urlopen(payload), \
+                mock.patch("builtins.print"):
+            f.main(pretty=pretty)
+            with open(f.FILENAME, encoding="utf-8") as out:
+                return out.read()
+
+    def test_rete(self):
+        for pretty in (False, True):
+            rete = json.loads(self.esegui(PAYLOAD, pretty))
+            self.assertEqual([n["name"] for n in rete["nodes"]], ["Firenze S.M.N.", "Pisa Centrale", "Forlì"])
+            self.assertEqual([n["type"] for n in rete["nodes"]], ["interchange", "interchange", "station"])
+            self.assertEqual([(e["from"], e["to"], e["trackType"], e["maxSpeed"]) for e in rete["edges"]],
+                             [("1", "2", "double", 180), ("2", "3", "double", 180)])
+            self.assertEqual(rete["lines"][0]["color"], "#FFA500")
+            self.assertEqual(rete["trains"], [])
+
+    def test_risposta_vuota(self):
+        with self.assertRaises(SystemExit) as ctx:
+            self.esegui({"remark": "runtime error"})
+        self.assertEqual(ctx.exception.code, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()